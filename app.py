@@ -1,7 +1,21 @@
 import os
+import sys
+import json
+import gzip
+import hashlib
+import queue
+import tarfile
+import threading
+import time
+import fcntl
 import requests
 import logging
-from flask import Flask, jsonify, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import orjson
+from flask import Flask, Response, request
 from flask_cors import CORS
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
@@ -11,14 +25,32 @@ from urllib.parse import quote
 BOT_TOKEN = os.environ.get('BOT_TOKEN', 'Your_Telegram_Bot_Token_Here')
 WEB_APP_URL = 'https://vasiliy-katsyka.github.io/colorGifts'
 SERVER_URL = os.environ.get('SERVER_URL')
+REPO_API_URL = 'https://api.github.com/repos/Vasiliy-katsyka/colorGifts'
+COLLECTIONS_URL = 'https://cdn.changes.tg/gifts/id-to-name.json'
+BACKDROPS_URL = 'https://cdn.changes.tg/gifts/backdrops.json'
+REPO_TARBALL_URL = 'https://codeload.github.com/Vasiliy-katsyka/colorGifts/tar.gz'
+HTTP_TIMEOUT = (3, 10)  # (connect, read) seconds
+FILTERS_MAX_AGE = 3600
+FILTERS_STALE_WHILE_REVALIDATE = 86400
+MODELS_MAX_AGE = 60
+DATA_REFRESH_INTERVAL = 15 * 60
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+CACHE_FILE = os.path.join(CACHE_DIR, 'cached_data.json')
 
 # --- INITIALIZE ---
-bot = telebot.TeleBot(BOT_TOKEN)
+# Not threaded: the app is preloaded in the Gunicorn master (see gunicorn.conf.py)
+# and telebot's worker pool threads would not survive the fork into workers.
+# Updates are processed off the request thread by process_updates_forever instead.
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "https://vasiliy-katsyka.github.io"}})
 
+# One pooled session for all outbound calls so TLS connections are reused
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])))
+
 # --- DATA CACHING ---
 CACHED_DATA = {
     "collections": [],
@@ -28,103 +60,363 @@ CACHED_DATA = {
         {"name": "orange"}, {"name": "yellow"}, {"name": "green"}, {"name": "cyan"},
         {"name": "blue"}, {"name": "purple"}, {"name": "pink"}, {"name": "unknown"}
     ],
-    "color_model_map": {}
+    "color_model_map": {},
+    "color_collection_json": {},
+    "color_models_body": {},
+    "filters_body": b"",
+    "filters_body_gzip": b"",
+    "filters_etag": "",
+    "filters_last_modified": None
 }
 
-def load_initial_data():
+# --- DISK CACHE ---
+def read_disk_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def get_repo_sha(cached):
+    # The sha media type returns just the 40-char SHA instead of the full commit and diff.
+    # Conditional request: a 304 doesn't count against GitHub's API rate limit
+    headers = {"Accept": "application/vnd.github.sha"}
+    if cached.get("repo_etag"):
+        headers["If-None-Match"] = cached["repo_etag"]
+    try:
+        res = SESSION.get(f"{REPO_API_URL}/commits/HEAD", headers=headers, timeout=HTTP_TIMEOUT)
+        if res.status_code == 304:
+            return cached["repo_sha"], cached["repo_etag"]
+        res.raise_for_status()
+        return res.text.strip(), res.headers.get("ETag")
+    except Exception as e:
+        logger.warning(f"Could not fetch repo commit SHA: {e}")
+        return None, None
+
+def restore_color_model_map(cached):
+    # JSON has no tuples, restore the (gift_name, model_name) pairs; interning shares
+    # the collection name that json.load would otherwise allocate once per model
+    return {
+        sys.intern(color): [(sys.intern(gift_name), sys.intern(model_name)) for gift_name, model_name in pairs]
+        for color, pairs in cached["color_model_map"].items()
+    }
+
+def fetch_json_cached(url, source, offline=False):
+    # Conditional GET against the copy on disk; the cached copy also covers an upstream outage
+    source = source or {}
+    if offline:
+        if "data" not in source:
+            raise LookupError(f"{url} is not in the disk cache")
+        return source
+    headers = {"If-None-Match": source["etag"]} if source.get("etag") else {}
+    try:
+        res = SESSION.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        if res.status_code == 304:
+            return source
+        res.raise_for_status()
+        return {"etag": res.headers.get("ETag"), "data": res.json()}
+    except Exception as e:
+        if "data" not in source:
+            raise
+        logger.warning(f"Using cached copy of {url}: {e}")
+        return source
+
+def save_cache_to_disk(cached):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_file = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmp_file, CACHE_FILE)
+        return True
+    except OSError as e:
+        logger.warning(f"Could not write data cache to disk: {e}")
+        return False
+
+def fetch_repo_model_files(ref):
+    # One tarball download replaces the contents listing plus one request per gift file
+    res = SESSION.get(f"{REPO_TARBALL_URL}/{ref}", stream=True, timeout=HTTP_TIMEOUT)
+    res.raise_for_status()
+    res.raw.decode_content = True
+    with tarfile.open(fileobj=res.raw, mode='r|gz') as tar:
+        for member in tar:
+            # Members look like "colorGifts-<sha>/Bow Tie.json"; only top-level files are gifts
+            path = member.name.split('/')
+            if not member.isfile() or len(path) != 2 or not path[1].endswith('.json'):
+                continue
+            gift_name = sys.intern(path[1][:-len('.json')])
+            try:
+                yield gift_name, orjson.loads(tar.extractfile(member).read())
+            except Exception:
+                # Supress errors for individual file processing to avoid crashing startup
+                yield gift_name, None
+
+def build_color_model_map(ref):
+    color_model_map = {}
+    complete = True
+    for gift_name, models_data in fetch_repo_model_files(ref):
+        if not isinstance(models_data, dict):
+            complete = False
+            continue
+        for model_name, model_data in models_data.items():
+            main_color = "unknown"
+            if isinstance(model_data, dict):
+                main_color = model_data.get("main_color", "unknown")
+            elif isinstance(model_data, str):
+                main_color = model_data
+            else:
+                continue
+            main_color = sys.intern(main_color)
+            model_name = sys.intern(model_name)
+
+            if main_color not in color_model_map:
+                color_model_map[main_color] = []
+            color_model_map[main_color].append((gift_name, model_name))
+    return color_model_map, complete
+
+def index_by_collection(color_model_map):
+    # color -> collection -> [response entry, ...], built once so /api/models only
+    # concatenates and collection filters don't rescan every pair
+    index = {}
+    for color, pairs in color_model_map.items():
+        by_collection = index[color] = {}
+        image_prefixes = {}
+        for gift_name, model_name in pairs:
+            if gift_name not in image_prefixes:
+                image_prefixes[gift_name] = f"https://cdn.changes.tg/gifts/models/{quote(gift_name)}/png/"
+            by_collection.setdefault(gift_name, []).append({
+                "collection": gift_name,
+                "model": model_name,
+                "imageUrl": f"{image_prefixes[gift_name]}{quote(model_name)}.png"
+            })
+    return index
+
+def encode_models_index(index):
+    # Encode every color/collection group once: /api/models joins the fragments a query
+    # needs instead of caching a body per client-chosen subset of collections
+    color_collection_json = {}
+    color_models_body = {}
+    for color, by_collection in index.items():
+        fragments = color_collection_json[color] = {
+            collection_name: orjson.dumps(entries)[1:-1] for collection_name, entries in by_collection.items()
+        }
+        body = b"[" + b",".join(fragments.values()) + b"]"
+        color_models_body[color] = (body, gzip.compress(body, compresslevel=6, mtime=0))
+    return color_collection_json, color_models_body
+
+def build_filters_body(data, cached):
+    # /api/filters only changes when data is (re)loaded, so encode it once
+    data["filters_body"] = orjson.dumps({
+        "collections": data["collections"],
+        "colors": data["colors"],
+        "backdrops": data["backdrops"]
+    })
+    data["filters_body_gzip"] = gzip.compress(data["filters_body"], compresslevel=9, mtime=0)
+    etag = hashlib.blake2b(data["filters_body"], digest_size=16).hexdigest()
+    # Last-Modified is stored with its ETag in the disk cache so restarts and every worker
+    # send the same value; it only moves forward when a reload actually changed the payload.
+    # Returns whether the disk cache needs saving
+    if etag == cached.get("filters_etag"):
+        data["filters_etag"] = etag
+        data["filters_last_modified"] = datetime.fromisoformat(cached["filters_last_modified"])
+        return False
+    if etag != data["filters_etag"]:
+        data["filters_etag"] = etag
+        data["filters_last_modified"] = datetime.now(timezone.utc).replace(microsecond=0)
+    cached.update(filters_etag=etag, filters_last_modified=data["filters_last_modified"].isoformat())
+    return True
+
+def load_initial_data(offline=False):
+    global CACHED_DATA
     logger.info("Loading initial gift model data...")
+    # Build into a copy and swap it in at the end so requests never see a half-loaded state;
+    # anything that fails to load keeps its previous value
+    data = dict(CACHED_DATA)
+    cached = read_disk_cache()
+    cached_sources = cached.get("sources", {})
+    cache_changed = False
     try:
-        # 1. Load Collections
-        collections_url = "https://cdn.changes.tg/gifts/id-to-name.json"
-        collections_res = requests.get(collections_url).json()
-        CACHED_DATA["collections"] = [{"id": k, "name": v} for k, v in collections_res.items()]
-        logger.info(f"Loaded {len(CACHED_DATA['collections'])} collections.")
-
-        # 2. Load Backdrops
-        backdrops_url = "https://cdn.changes.tg/gifts/backdrops.json"
-        CACHED_DATA["backdrops"] = requests.get(backdrops_url).json()
-        logger.info(f"Loaded {len(CACHED_DATA['backdrops'])} backdrops.")
-
-        # 3. Load Color Data for models
-        color_repo_api = "https://api.github.com/repos/Vasiliy-katsyka/colorGifts/contents/"
-        files = requests.get(color_repo_api).json()
-        
-        for file_info in files:
-            if isinstance(file_info, dict) and file_info.get('name', '').endswith('.json'):
-                gift_name = file_info['name'].replace('.json', '')
-                content_url = file_info['download_url']
-                
-                try:
-                    models_data = requests.get(content_url).json()
-                    for model_name, model_data in models_data.items():
-                        main_color = "unknown"
-                        if isinstance(model_data, dict):
-                            main_color = model_data.get("main_color", "unknown")
-                        elif isinstance(model_data, str):
-                            main_color = model_data
-                        else:
-                            continue
-                        
-                        if main_color not in CACHED_DATA["color_model_map"]:
-                            CACHED_DATA["color_model_map"][main_color] = []
-                        CACHED_DATA["color_model_map"][main_color].append((gift_name, model_name))
-                except Exception:
-                    # Supress errors for individual file processing to avoid crashing startup
-                    pass
-        
-        logger.info("Finished loading color model map.")
+        # 1. Start the Collections and Backdrops downloads so they overlap with the color data
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            collections_future = executor.submit(fetch_json_cached, COLLECTIONS_URL, cached_sources.get(COLLECTIONS_URL), offline)
+            backdrops_future = executor.submit(fetch_json_cached, BACKDROPS_URL, cached_sources.get(BACKDROPS_URL), offline)
+
+            # 2. Load Color Data for models, reusing the disk cache while the repo is unchanged
+            try:
+                repo_sha, repo_etag = (None, None) if offline else get_repo_sha(cached)
+                # Without a SHA (network error, rate limit) the cached map beats rebuilding from HEAD
+                cache_usable = "color_model_map" in cached and (repo_sha is None or cached.get("repo_sha") == repo_sha)
+                color_model_map = restore_color_model_map(cached) if cache_usable else None
+                if color_model_map is not None:
+                    logger.info(f"Loaded color model map from disk cache ({cached['repo_sha'][:7]}).")
+                    # Same commit under a new ETag (e.g. after an Accept change): keep it so later checks get a 304
+                    if repo_sha and repo_etag != cached.get("repo_etag"):
+                        cached["repo_etag"] = repo_etag
+                        cache_changed = True
+                elif offline:
+                    logger.info("No color model map in disk cache yet; keeping the current one.")
+                else:
+                    color_model_map, complete = build_color_model_map(repo_sha or 'HEAD')
+                    # Only persist a full build so a failed file isn't cached until the next commit
+                    if repo_sha and complete:
+                        cached.update(repo_sha=repo_sha, repo_etag=repo_etag, color_model_map=color_model_map)
+                        cache_changed = True
+                if color_model_map is not None:
+                    data["color_model_map"] = color_model_map
+                    data["color_collection_json"], data["color_models_body"] = encode_models_index(index_by_collection(color_model_map))
+                    logger.info("Finished loading color model map.")
+            except Exception as e:
+                logger.error(f"Failed to load color model map: {e}", exc_info=True)
 
+            # 3. Collect Collections and Backdrops
+            sources = {COLLECTIONS_URL: collections_future.result(), BACKDROPS_URL: backdrops_future.result()}
+            data["collections"] = [{"id": k, "name": v} for k, v in sources[COLLECTIONS_URL]["data"].items()]
+            logger.info(f"Loaded {len(data['collections'])} collections.")
+            data["backdrops"] = sources[BACKDROPS_URL]["data"]
+            logger.info(f"Loaded {len(data['backdrops'])} backdrops.")
+
+        if sources != cached_sources:
+            cached["sources"] = sources
+            cache_changed = True
     except Exception as e:
         logger.error(f"An unexpected error occurred during initial data load: {e}", exc_info=True)
+    cache_changed |= build_filters_body(data, cached)
+    # Save even if a source failed so a freshly built color map isn't thrown away. Workers
+    # reloading offline only read the cache the refresher wrote
+    cache_saved = save_cache_to_disk(cached) if cache_changed and not offline else True
+    CACHED_DATA = data
+    # Whether the disk cache holds what was just loaded, for the workers reading it
+    return cache_saved
+
+def refresh_data_forever():
+    # Every worker runs this loop, but only the one holding the lock refreshes from upstream.
+    # The lock is held until that worker exits, then another one takes over. The rest reload
+    # offline from the disk cache it writes, so they can lag it by up to one interval.
+    # After each pass whose data reached the disk, the holder touches the lock file; if that
+    # stops (e.g. saves failing on a full disk), the other workers refresh online themselves.
+    lock_path = os.path.join(CACHE_DIR, 'refresh.lock')
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        lock_file = open(lock_path, 'a')
+    except OSError as e:
+        # No usable disk: there's no cache to share either, so every worker refreshes itself
+        logger.warning(f"Could not open refresh lock, refreshing in every worker: {e}")
+        lock_file = None
+    cache_mtime = None
+    while True:
+        time.sleep(DATA_REFRESH_INTERVAL)
+        if lock_file is None:
+            load_initial_data()
+            continue
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            try:
+                heartbeat = os.path.getmtime(lock_path)
+                mtime = os.path.getmtime(CACHE_FILE)
+            except OSError:
+                heartbeat = mtime = None
+            if heartbeat is None or time.time() - heartbeat > 2 * DATA_REFRESH_INTERVAL:
+                load_initial_data()
+            elif mtime != cache_mtime:
+                cache_mtime = mtime
+                load_initial_data(offline=True)
+            continue
+        if load_initial_data():
+            try:
+                os.utime(lock_path)
+            except OSError as e:
+                logger.warning(f"Could not touch refresh lock: {e}")
+
+
+# --- BACKGROUND THREADS ---
+_background_threads = {}
+_background_threads_lock = threading.Lock()
+
+def ensure_background_thread(target):
+    # Started lazily so threads live in the serving process, not the preloaded master
+    if target in _background_threads:
+        return
+    with _background_threads_lock:
+        if target not in _background_threads:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            _background_threads[target] = thread
+
+@app.before_request
+def start_data_refresh():
+    ensure_background_thread(refresh_data_forever)
 
 
 # --- API ENDPOINTS ---
 
+def ojsonify(obj, status=200):
+    # orjson encodes straight to bytes and is several times faster than flask.jsonify
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+def precompressed_response(body, gzip_body=None):
+    # Cached bodies come with a gzip copy made at load time; others are compressed on demand
+    if request.accept_encodings['gzip']:
+        if gzip_body is None:
+            gzip_body = gzip.compress(body, compresslevel=6, mtime=0)
+        response = Response(gzip_body, mimetype='application/json')
+        response.content_encoding = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/api/filters', methods=['GET'])
 def get_filters():
-    # Now returns collections, colors, AND backdrops
-    return jsonify({
-        "collections": CACHED_DATA["collections"],
-        "colors": CACHED_DATA["colors"],
-        "backdrops": CACHED_DATA["backdrops"]
-    })
+    # Now returns collections, colors, AND backdrops, pre-encoded by build_filters_body
+    data = CACHED_DATA
+    response = precompressed_response(data["filters_body"], data["filters_body_gzip"])
+    # Each encoding is a separate representation and needs its own ETag
+    etag = data["filters_etag"]
+    response.set_etag(f"{etag}-gzip" if response.content_encoding == 'gzip' else etag)
+    response.last_modified = data["filters_last_modified"]
+    response.headers['Cache-Control'] = f"public, max-age={FILTERS_MAX_AGE}, stale-while-revalidate={FILTERS_STALE_WHILE_REVALIDATE}"
+    return response.make_conditional(request)
 
 @app.route('/api/models', methods=['GET'])
 def get_models():
     args = request.args
     color = args.get('color')
-    collections = args.get('collections', '').split(',') if args.get('collections') else []
+    collections = set(args.get('collections', '').split(',')) if args.get('collections') else set()
 
     if not color:
-        return jsonify({"error": "Color parameter is required"}), 400
+        return ojsonify({"error": "Color parameter is required"}, 400)
 
-    models_for_color = CACHED_DATA["color_model_map"].get(color, [])
-    
+    data = CACHED_DATA
     if collections:
-        filtered_models = [m for m in models_for_color if m[0] in collections]
+        # Unknown collection names are simply skipped
+        fragments = data["color_collection_json"].get(color, {})
+        body = b"[" + b",".join(fragments[name] for name in sorted(collections) if name in fragments) + b"]"
+        response = precompressed_response(body)
     else:
-        filtered_models = models_for_color
-    
-    response_data = []
-    for collection_name, model_name in filtered_models:
-        encoded_collection = quote(collection_name)
-        encoded_model = quote(model_name)
-        image_url = f"https://cdn.changes.tg/gifts/models/{encoded_collection}/png/{encoded_model}.png"
-        
-        response_data.append({
-            "collection": collection_name,
-            "model": model_name,
-            "imageUrl": image_url
-        })
-    
-    return jsonify(response_data)
-
-# --- TELEGRAM BOT & WEBHOOK LOGIC (Unchanged) ---
+        response = precompressed_response(*data["color_models_body"].get(color, (b"[]", None)))
+    response.cache_control.public = True
+    response.cache_control.max_age = MODELS_MAX_AGE
+    return response
+
+# --- TELEGRAM BOT & WEBHOOK LOGIC ---
+# Updates are handed to a background thread so Telegram gets its 200 immediately
+UPDATE_QUEUE = queue.Queue()
+
+def process_updates_forever():
+    while True:
+        body = UPDATE_QUEUE.get()
+        try:
+            update = telebot.types.Update.de_json(orjson.loads(body))
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Failed to process Telegram update: {e}", exc_info=True)
+
 @app.route('/api/' + BOT_TOKEN, methods=['POST'])
 def webhook():
     if request.headers.get('content-type') == 'application/json':
-        update = telebot.types.Update.de_json(request.get_data().decode('utf-8'))
-        bot.process_new_updates([update])
+        ensure_background_thread(process_updates_forever)
+        UPDATE_QUEUE.put_nowait(request.get_data())
         return '', 200
     return 'Unsupported Media Type', 415
 
@@ -136,6 +428,7 @@ def send_welcome(message):
     bot.send_message(message.chat.id, "Welcome! Click the button below to browse a gallery of gift models by color, collection, and backdrop.", reply_markup=markup)
 
 # --- STARTUP LOGIC ---
+# With preload_app this runs once in the Gunicorn master and workers inherit the data.
 if __name__ != '__main__':
     load_initial_data()
     if SERVER_URL and BOT_TOKEN:
@@ -143,3 +436,5 @@ if __name__ != '__main__':
         bot.remove_webhook()
         bot.set_webhook(url=webhook_url, timeout=20)
         logger.info(f"Webhook set to {webhook_url}")
+    # Drop the master's keep-alive sockets so forked workers open their own connections
+    SESSION.close()
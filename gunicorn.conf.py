@@ -0,0 +1,20 @@
+import os
+
+# --- GUNICORN CONFIGURATION ---
+# Import app.py once in the master so load_initial_data and the webhook setup
+# run a single time; forked workers share the loaded CACHED_DATA.
+preload_app = True
+
+# Threaded workers so one slow client or webhook doesn't block the others
+worker_class = 'gthread'
+# One worker per usable CPU (what `nproc` reports); os.cpu_count() would count the
+# host's cores inside a container. sched_getaffinity is Linux-only, so fall back elsewhere
+if 'WEB_CONCURRENCY' in os.environ:
+    workers = int(os.environ['WEB_CONCURRENCY'])
+elif hasattr(os, 'sched_getaffinity'):
+    workers = len(os.sched_getaffinity(0))
+else:
+    workers = os.cpu_count() or 1
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+timeout = 30
+keepalive = 5